@@ -9,10 +9,15 @@ Input format:
     "input": {
         "source_image": "base64 encoded image or URL",
         "driving_video": "base64 encoded video or URL",
+        "source_image_s3_key": "optional object key in INPUT_BUCKET, instead of source_image",
+        "driving_video_s3_key": "optional object key in INPUT_BUCKET, instead of driving_video",
         "audio": "optional base64 audio or URL for lip sync",
         "flag_relative": true,
         "flag_do_crop": true,
-        "flag_pasteback": true
+        "flag_pasteback": true,
+        "max_frames": 0,
+        "fps_divisor": 1,
+        "force_rate": 0
     }
 }
 
@@ -25,52 +30,363 @@ Output format:
 
 import os
 import sys
-import json
-import base64
+import asyncio
+import copy
+import shutil
+import binascii
+import mmap
 import tempfile
 import subprocess
+import threading
 import time
-import urllib.request
+import uuid
 from pathlib import Path
 
 # Add ComfyUI to path
 sys.path.insert(0, '/content/ComfyUI')
 
+import boto3
+import httpx
+import orjson
+import requests
 import runpod
+import websockets
+from boto3.s3.transfer import TransferConfig
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration
 COMFYUI_DIR = "/content/ComfyUI"
-INPUT_DIR = os.path.join(COMFYUI_DIR, "input")
+COMFYUI_INPUT_DIR = os.path.join(COMFYUI_DIR, "input")
 OUTPUT_DIR = os.path.join(COMFYUI_DIR, "output")
 
-# Ensure directories exist
-os.makedirs(INPUT_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Debug: list the output directory after each job (walks every file)
+DEBUG_LIST_OUTPUTS = bool(os.environ.get("DEBUG_LIST_OUTPUTS"))
+
+# Outputs older than this are pruned in the background (0 disables pruning)
+OUTPUT_MAX_AGE = int(os.environ.get("OUTPUT_MAX_AGE_MINUTES", 60)) * 60
+OUTPUT_PRUNE_INTERVAL = 600  # seconds
+
+# Extensions accepted when locating the generated video
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.avi', '.mov')
+
+# ComfyUI API endpoint (running locally in the container)
+COMFYUI_API_URL = "http://127.0.0.1:7860"
+COMFYUI_WS_URL = "ws://127.0.0.1:7860/ws"
+
+# Maximum time to wait for a single workflow to finish
+WORKFLOW_TIMEOUT = 300  # 5 minutes max
+
+# Minimum time allowed for fetching a prompt's history once waiting is over
+HISTORY_GRACE = 5
+
+# Output encoders: NVENC is used when the GPU and VHS_VideoCombine support it
+DEFAULT_VIDEO_FORMAT = "video/h264-mp4"
+NVENC_VIDEO_FORMAT = "video/nvenc_h264-mp4"
+
+# Stable client id for this worker; ComfyUI routes progress events by it
+CLIENT_ID = uuid.uuid4().hex
+
+# Shared HTTP session so input downloads reuse keep-alive connections
+SESSION = requests.Session()
+for _scheme in ("http://", "https://"):
+    SESSION.mount(_scheme, HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2)
+    ))
+
+# Copy buffer for streaming downloads to disk
+DOWNLOAD_CHUNK = 1 << 20
+
+# Stage inputs on tmpfs when they fit; ComfyUI reaches them via a symlink.
+# /dev/shm is RAM-backed, so always leave SHM_MIN_FREE bytes free.
+SHM_DIR = "/dev/shm/lp_in"
+SHM_INPUT_DIR = os.path.join(COMFYUI_INPUT_DIR, "shm")
+SHM_MIN_FREE = int(os.environ.get("SHM_MIN_FREE", 1 << 30))  # 1 GiB
+
+
+def setup_shm_link() -> bool:
+    """Create SHM_DIR and link it into ComfyUI's input folder as "shm"."""
+    try:
+        os.makedirs(SHM_DIR, exist_ok=True)
+        if os.path.realpath(SHM_INPUT_DIR) != SHM_DIR:
+            if os.path.islink(SHM_INPUT_DIR):
+                os.unlink(SHM_INPUT_DIR)
+            os.symlink(SHM_DIR, SHM_INPUT_DIR)
+        return True
+    except OSError as e:
+        print(f"tmpfs staging unavailable, using {COMFYUI_INPUT_DIR}: {e}")
+        return False
+
+
+def staging_path(filename: str, size: int = None) -> str:
+    """
+    Choose where to write an input of `size` bytes.
+
+    Uses tmpfs if the input fits while leaving SHM_MIN_FREE bytes free, otherwise
+    (or when the size isn't known up front) ComfyUI's input folder.
+    """
+    if SHM_AVAILABLE and size is not None:
+        try:
+            if shutil.disk_usage(SHM_DIR).free - size >= SHM_MIN_FREE:
+                return os.path.join(SHM_INPUT_DIR, filename)
+        except OSError:
+            pass
+    return os.path.join(COMFYUI_INPUT_DIR, filename)
+
 
+def remove_staged_inputs(paths: list):
+    """Delete input files staged for a finished job."""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
-def download_file(url: str, output_path: str) -> str:
-    """Download a file from URL to the specified path."""
-    print(f"Downloading {url} to {output_path}")
-    urllib.request.urlretrieve(url, output_path)
+
+# Ensure directories exist
+os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+SHM_AVAILABLE = setup_shm_link()
+
+# Base64 chunk sizes: decode in multiples of 4 chars, encode in multiples of 3 bytes,
+# so every chunk maps onto whole base64 quanta and can be processed independently
+B64_DECODE_CHUNK = 4 * 1024 * 1024
+B64_ENCODE_CHUNK = 3 * 1024 * 1024
+
+# Object storage for inputs/outputs (S3 or any S3-compatible store such as R2).
+# When OUTPUT_BUCKET is unset the video is returned inline as base64.
+# Inputs given as *_s3_key are read from INPUT_BUCKET (defaults to OUTPUT_BUCKET).
+OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET")
+INPUT_BUCKET = os.environ.get("INPUT_BUCKET") or OUTPUT_BUCKET
+OUTPUT_URL_EXPIRY = int(os.environ.get("OUTPUT_URL_EXPIRY", 3600))
+S3 = boto3.client("s3", endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 << 20,
+    multipart_chunksize=8 << 20,
+    use_threads=True
+)
+
+
+def download_file(url: str, filename: str) -> str:
+    """Download a file from URL into the input staging area and return its path."""
+    with SESSION.get(url, stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        # The on-disk size is only known up front for unencoded bodies
+        length = int(response.headers.get("Content-Length", 0))
+        if "Content-Encoding" in response.headers:
+            length = 0
+        output_path = staging_path(filename, length or None)
+        print(f"Downloading {url} to {output_path}")
+
+        with open(output_path, 'wb') as f:
+            # Preallocate when the size is known
+            if length > 0 and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, length)
+            shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK)
     return output_path
 
 
 def save_base64_file(data: str, output_path: str) -> str:
-    """Save base64 encoded data to a file."""
+    """Save base64 encoded data to a file, decoding chunk by chunk."""
     # Remove data URI prefix if present
     if ',' in data:
         data = data.split(',', 1)[1]
 
-    binary_data = base64.b64decode(data)
-    with open(output_path, 'wb') as f:
-        f.write(binary_data)
+    with open(output_path, 'wb', buffering=1 << 20) as f:
+        carry = ''
+        for i in range(0, len(data), B64_DECODE_CHUNK):
+            # Drop line breaks (MIME-style input) and decode whole 4-char groups,
+            # carrying any remainder over to the next chunk
+            chunk = carry + ''.join(data[i:i + B64_DECODE_CHUNK].split())
+            usable = len(chunk) - len(chunk) % 4
+            f.write(binascii.a2b_base64(chunk[:usable]))
+            carry = chunk[usable:]
+        if carry:
+            f.write(binascii.a2b_base64(carry))
+    return output_path
+
+
+def download_s3_file(key: str, filename: str) -> str:
+    """Download an object from INPUT_BUCKET into the input staging area and return its path."""
+    if not INPUT_BUCKET:
+        raise Exception("INPUT_BUCKET or OUTPUT_BUCKET must be set to use *_s3_key inputs")
+    size = S3.head_object(Bucket=INPUT_BUCKET, Key=key)["ContentLength"]
+    output_path = staging_path(filename, size)
+    print(f"Downloading s3://{INPUT_BUCKET}/{key} to {output_path}")
+    S3.download_file(INPUT_BUCKET, key, output_path, Config=S3_TRANSFER_CONFIG)
     return output_path
 
 
+def fetch_input(data: str, filename: str) -> str:
+    """Download a URL or decode base64 data into the input staging area and return its path."""
+    if data.startswith("http"):
+        return download_file(data, filename)
+    # Decoded size is at most 3/4 of the encoded length
+    return save_base64_file(data, staging_path(filename, len(data) * 3 // 4))
+
+
+def get_input_source(job_input: dict, name: str):
+    """
+    Pick the fetcher for an input given as `<name>_s3_key`, `<name>` or `<name>_url`.
+
+    Returns a (fetch_fn, value) pair, or None if the input is absent. Fetchers take
+    the value and a filename, and return the path they staged the input at.
+    """
+    s3_key = job_input.get(f"{name}_s3_key")
+    if s3_key:
+        return download_s3_file, s3_key
+    value = job_input.get(name) or job_input.get(f"{name}_url")
+    if value:
+        return fetch_input, value
+    return None
+
+
 def file_to_base64(file_path: str) -> str:
-    """Convert a file to base64 string."""
-    with open(file_path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+    """Convert a file to base64 string, encoding a memory-mapped view chunk by chunk."""
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return ''
+
+    # Base64 output length is known exactly: 4 * ceil(n / 3)
+    buf = bytearray(((size + 2) // 3) * 4)
+    view = memoryview(buf)
+    pos = 0
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as src:
+        # Slicing the memoryview hands the encoder page-cache pages without a copy;
+        # the view is released before the mmap closes
+        for i in range(0, size, B64_ENCODE_CHUNK):
+            chunk = binascii.b2a_base64(src[i:i + B64_ENCODE_CHUNK], newline=False)
+            view[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+    view.release()
+    return buf.decode('ascii')
+
+
+def upload_to_s3(file_path: str) -> str:
+    """Upload a file to OUTPUT_BUCKET and return a presigned download URL."""
+    key = f"liveportrait/{uuid.uuid4().hex}_{os.path.basename(file_path)}"
+    print(f"Uploading {file_path} to s3://{OUTPUT_BUCKET}/{key}")
+    S3.upload_file(
+        file_path, OUTPUT_BUCKET, key,
+        ExtraArgs={"ContentType": "video/mp4"},
+        Config=S3_TRANSFER_CONFIG
+    )
+    return S3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": OUTPUT_BUCKET, "Key": key},
+        ExpiresIn=OUTPUT_URL_EXPIRY
+    )
+
+
+# Static LivePortrait workflow. Only nodes "3", "4", "6" and "7" vary per request;
+# get_liveportrait_workflow overlays those onto a shallow copy. Nodes "1" and "2"
+# must stay byte-identical across prompts (and the warmup) so ComfyUI's execution
+# cache keeps the loaded pipeline and cropper instead of reloading them.
+_WORKFLOW_TEMPLATE = {
+    # Node 1: Load LivePortrait pipeline/models
+    "1": {
+        "class_type": "DownloadAndLoadLivePortraitModels",
+        "inputs": {
+            "precision": "auto",
+            "mode": "human"
+        }
+    },
+    # Node 2: Load face cropper (InsightFace-based)
+    "2": {
+        "class_type": "LivePortraitLoadCropper",
+        "inputs": {
+            "onnx_device": "CUDA",
+            "keep_model_loaded": True,
+            "detection_threshold": 0.5
+        }
+    },
+    # Node 3: Load source image
+    "3": {
+        "class_type": "LoadImage",
+        "inputs": {
+            "image": None
+        }
+    },
+    # Node 4: Load driving video as frames
+    "4": {
+        "class_type": "VHS_LoadVideo",
+        "inputs": {
+            "video": None,
+            "force_rate": 0,
+            "custom_width": 0,
+            "custom_height": 0,
+            "frame_load_cap": 0,
+            "skip_first_frames": 0,
+            "select_every_nth": 1
+        }
+    },
+    # Node 5: Crop and prepare source face
+    "5": {
+        "class_type": "LivePortraitCropper",
+        "inputs": {
+            "pipeline": ["1", 0],
+            "cropper": ["2", 0],
+            "source_image": ["3", 0],
+            "dsize": 512,
+            "scale": 2.3,
+            "vx_ratio": 0.0,
+            "vy_ratio": -0.125,
+            "face_index": 0,
+            "face_index_order": "large-small",
+            "rotate": True
+        }
+    },
+    # Node 6: Process with LivePortrait
+    "6": {
+        "class_type": "LivePortraitProcess",
+        "inputs": {
+            "pipeline": ["1", 0],
+            "crop_info": ["5", 1],  # Index 1 is CROPINFO, index 0 is cropped IMAGE
+            "source_image": ["3", 0],
+            "driving_images": ["4", 0],
+            "lip_zero": False,
+            "lip_zero_threshold": 0.03,
+            "stitching": True,
+            "delta_multiplier": 1.0,
+            "mismatch_method": "constant",
+            "relative_motion_mode": "relative",
+            "driving_smooth_observation_variance": 3e-6,
+            "expression_friendly": False,
+            "expression_friendly_multiplier": 1.0
+        }
+    },
+    # Node 7: Combine frames into video
+    "7": {
+        "class_type": "VHS_VideoCombine",
+        "inputs": {
+            "images": ["6", 0],
+            "frame_rate": ["8", 5],  # loaded_fps: honours force_rate and select_every_nth
+            "loop_count": 0,
+            "filename_prefix": "liveportrait_output",
+            "format": "video/h264-mp4",
+            "pingpong": False,
+            "save_output": True
+        }
+    },
+    # Node 8: Report the driving video's fps as loaded by node 4
+    "8": {
+        "class_type": "VHS_VideoInfo",
+        "inputs": {
+            "video_info": ["4", 3]
+        }
+    }
+}
+
+
+def comfy_input_name(path: str) -> str:
+    """Name ComfyUI's loaders use for a file under its input folder."""
+    return os.path.relpath(path, COMFYUI_INPUT_DIR)
 
 
 def get_liveportrait_workflow(source_image_path: str, driving_video_path: str,
@@ -86,243 +402,593 @@ def get_liveportrait_workflow(source_image_path: str, driving_video_path: str,
     5. LivePortraitCropper -> crop_info
     6. LivePortraitProcess -> animated frames
     7. VHS_VideoCombine -> output video
+    8. VHS_VideoInfo -> loaded fps, used as node 7's frame rate
     """
-    workflow = {
-        # Node 1: Load LivePortrait pipeline/models
-        "1": {
-            "class_type": "DownloadAndLoadLivePortraitModels",
-            "inputs": {
-                "precision": "auto",
-                "mode": "human"
-            }
-        },
-        # Node 2: Load face cropper (InsightFace-based)
-        "2": {
-            "class_type": "LivePortraitLoadCropper",
-            "inputs": {
-                "onnx_device": "CUDA",
-                "keep_model_loaded": True,
-                "detection_threshold": 0.5
-            }
-        },
-        # Node 3: Load source image
-        "3": {
-            "class_type": "LoadImage",
-            "inputs": {
-                "image": os.path.basename(source_image_path)
-            }
-        },
-        # Node 4: Load driving video as frames
-        "4": {
-            "class_type": "VHS_LoadVideo",
-            "inputs": {
-                "video": os.path.basename(driving_video_path),
-                "force_rate": 0,
-                "custom_width": 0,
-                "custom_height": 0,
-                "frame_load_cap": 0,
-                "skip_first_frames": 0,
-                "select_every_nth": 1
-            }
-        },
-        # Node 5: Crop and prepare source face
-        "5": {
-            "class_type": "LivePortraitCropper",
-            "inputs": {
-                "pipeline": ["1", 0],
-                "cropper": ["2", 0],
-                "source_image": ["3", 0],
-                "dsize": 512,
-                "scale": 2.3,
-                "vx_ratio": 0.0,
-                "vy_ratio": -0.125,
-                "face_index": 0,
-                "face_index_order": "large-small",
-                "rotate": True
-            }
-        },
-        # Node 6: Process with LivePortrait
-        "6": {
-            "class_type": "LivePortraitProcess",
-            "inputs": {
-                "pipeline": ["1", 0],
-                "crop_info": ["5", 1],  # Index 1 is CROPINFO, index 0 is cropped IMAGE
-                "source_image": ["3", 0],
-                "driving_images": ["4", 0],
-                "lip_zero": False,
-                "lip_zero_threshold": 0.03,
-                "stitching": True,
-                "delta_multiplier": kwargs.get("driving_multiplier", 1.0),
-                "mismatch_method": "constant",
-                "relative_motion_mode": kwargs.get("relative_motion_mode", "relative"),
-                "driving_smooth_observation_variance": 3e-6,
-                "expression_friendly": False,
-                "expression_friendly_multiplier": 1.0
-            }
-        },
-        # Node 7: Combine frames into video
-        "7": {
-            "class_type": "VHS_VideoCombine",
-            "inputs": {
-                "images": ["6", 0],
-                "frame_rate": 25,
-                "loop_count": 0,
-                "filename_prefix": "liveportrait_output",
-                "format": "video/h264-mp4",
-                "pingpong": False,
-                "save_output": True
-            }
-        }
-    }
+    workflow = copy.copy(_WORKFLOW_TEMPLATE)
+    workflow["3"] = {**workflow["3"], "inputs": {
+        **workflow["3"]["inputs"],
+        "image": comfy_input_name(source_image_path)
+    }}
+    workflow["4"] = {**workflow["4"], "inputs": {
+        **workflow["4"]["inputs"],
+        "video": comfy_input_name(driving_video_path),
+        "force_rate": float(kwargs.get("force_rate") or 0),
+        "frame_load_cap": int(kwargs.get("max_frames") or 0),
+        "select_every_nth": max(int(kwargs.get("fps_divisor") or 1), 1)
+    }}
+    workflow["6"] = {**workflow["6"], "inputs": {
+        **workflow["6"]["inputs"],
+        "delta_multiplier": kwargs.get("driving_multiplier", 1.0),
+        "relative_motion_mode": kwargs.get("relative_motion_mode", "relative")
+    }}
+    workflow["7"] = {**workflow["7"], "inputs": {
+        **workflow["7"]["inputs"],
+        "filename_prefix": kwargs.get("filename_prefix", "liveportrait_output"),
+        "format": kwargs.get("video_format") or DEFAULT_VIDEO_FORMAT
+    }}
 
     return workflow
 
 
-def run_comfyui_workflow(workflow: dict) -> dict:
+_client = None
+
+
+def get_comfyui_client() -> httpx.AsyncClient:
+    """Return the shared ComfyUI API client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=COMFYUI_API_URL,
+            limits=httpx.Limits(max_keepalive_connections=16),
+            timeout=30.0
+        )
+    return _client
+
+
+_video_format = None
+
+
+def nvenc_encode_works() -> bool:
+    """Run a tiny h264_nvenc test encode with the ffmpeg VideoHelperSuite is likely to use."""
+    ffmpeg = os.environ.get("VHS_FORCE_FFMPEG_PATH") or shutil.which("ffmpeg")
+    if not ffmpeg:
+        import imageio_ffmpeg
+        ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+
+    result = subprocess.run(
+        [ffmpeg, "-hide_banner", "-loglevel", "error",
+         "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+         "-c:v", "h264_nvenc", "-f", "null", "-"],
+        capture_output=True, timeout=30
+    )
+    if result.returncode != 0:
+        print(f"NVENC test encode failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.returncode == 0
+
+
+async def detect_video_format() -> str:
+    """
+    Pick the VHS_VideoCombine output format, preferring NVENC hardware encoding.
+
+    Falls back to the libx264 format when CUDA isn't available, the installed
+    VideoHelperSuite doesn't offer an NVENC format, or ffmpeg can't actually
+    encode with h264_nvenc. Run once from _warmup; jobs read the cached result
+    through get_video_format.
+    """
+    global _video_format
+    _video_format = DEFAULT_VIDEO_FORMAT
+    try:
+        import torch
+        if torch.cuda.is_available():
+            response = await get_comfyui_client().get("/object_info/VHS_VideoCombine")
+            response.raise_for_status()
+            node_info = orjson.loads(response.content)["VHS_VideoCombine"]
+            formats = node_info["input"]["required"]["format"][0]
+            if NVENC_VIDEO_FORMAT in formats and await asyncio.to_thread(nvenc_encode_works):
+                _video_format = NVENC_VIDEO_FORMAT
+    except Exception as e:
+        print(f"Could not check for NVENC support, using {_video_format}: {e}")
+
+    print(f"Using output video format: {_video_format}")
+    return _video_format
+
+
+def get_video_format() -> str:
+    """Return the output format chosen at warmup, or libx264 if it never ran."""
+    return _video_format or DEFAULT_VIDEO_FORMAT
+
+
+async def wait_for_prompts_ws(ws, prompt_ids: set):
     """
-    Execute a ComfyUI workflow and return the output.
+    Wait on ComfyUI's event stream until every prompt in `prompt_ids` finishes.
 
-    This uses ComfyUI's API to queue and execute the workflow.
+    ComfyUI signals the end of a run with an "executing" event whose node is None,
+    or with an "execution_error" event if it failed.
     """
-    import requests
+    pending = set(prompt_ids)
+    async for message in ws:
+        if not isinstance(message, str):
+            continue  # Binary preview frames
+
+        msg = orjson.loads(message)
+        data = msg.get("data", {})
+        if data.get("prompt_id") not in pending:
+            continue
+        if msg.get("type") == "execution_error" or (
+                msg.get("type") == "executing" and data.get("node") is None):
+            pending.discard(data["prompt_id"])
+            if not pending:
+                return
 
-    # ComfyUI API endpoint (running locally in the container)
-    api_url = "http://127.0.0.1:7860"
+    raise websockets.WebSocketException("Connection closed before the prompts finished")
 
-    # Queue the prompt
-    response = requests.post(
-        f"{api_url}/prompt",
-        json={"prompt": workflow}
+
+async def poll_history(prompt_id: str, timeout: float) -> dict:
+    """
+    Poll ComfyUI's history endpoint until the prompt completes.
+
+    Starts polling fast and backs off exponentially so short jobs aren't
+    penalised by a long fixed sleep.
+    """
+    client = get_comfyui_client()
+    start_time = time.time()
+    delay = 0.05
+
+    while time.time() - start_time < timeout:
+        history_response = await client.get(f"/history/{prompt_id}")
+
+        if history_response.status_code == 200:
+            history = orjson.loads(history_response.content)
+            entry = history.get(prompt_id)
+            if entry is not None:
+                status = entry.get("status", {})
+                if status.get("completed", True) or status.get("status_str") == "error":
+                    return entry
+        elif history_response.status_code >= 500:
+            # Server hiccup: start over with a short interval
+            delay = 0.05
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 1.0)
+
+    raise Exception("Workflow execution timed out")
+
+
+async def queue_prompt(client: httpx.AsyncClient, workflow: dict) -> str:
+    """Queue a workflow on ComfyUI and return its prompt_id."""
+    response = await client.post(
+        "/prompt",
+        content=orjson.dumps({"prompt": workflow, "client_id": CLIENT_ID}),
+        headers={"Content-Type": "application/json"}
     )
 
     if response.status_code != 200:
         raise Exception(f"Failed to queue prompt: {response.text}")
 
-    result = response.json()
+    result = orjson.loads(response.content)
     prompt_id = result.get("prompt_id")
 
     if not prompt_id:
         raise Exception(f"No prompt_id in response: {result}")
 
-    # Poll for completion
-    max_wait = 300  # 5 minutes max
-    start_time = time.time()
+    return prompt_id
 
-    while time.time() - start_time < max_wait:
-        history_response = requests.get(f"{api_url}/history/{prompt_id}")
 
-        if history_response.status_code == 200:
-            history = history_response.json()
-            if prompt_id in history:
-                return history[prompt_id]
+async def run_comfyui_workflows(workflows: list) -> list:
+    """
+    Execute several ComfyUI workflows and return one run per workflow.
 
-        time.sleep(2)
+    All prompts are queued back-to-back and awaited over a single WebSocket,
+    falling back to history polling if the socket is unavailable. Each run is
+    a dict with the history entry, the output path and an error message (None
+    on success); one prompt failing to queue or finish doesn't affect the others.
+    """
+    client = get_comfyui_client()
+    deadline = time.time() + WORKFLOW_TIMEOUT * len(workflows)
 
-    raise Exception("Workflow execution timed out")
+    # Subscribe before queueing so no completion event can be missed
+    try:
+        ws = await websockets.connect(f"{COMFYUI_WS_URL}?clientId={CLIENT_ID}", max_size=None)
+    except (OSError, websockets.WebSocketException) as e:
+        print(f"WebSocket unavailable, falling back to polling: {e}")
+        ws = None
+
+    try:
+        queued = await asyncio.gather(
+            *(queue_prompt(client, wf) for wf in workflows),
+            return_exceptions=True
+        )
+        prompt_ids = {pid for pid in queued if not isinstance(pid, BaseException)}
+
+        if ws is not None and prompt_ids:
+            try:
+                await asyncio.wait_for(wait_for_prompts_ws(ws, prompt_ids), deadline - time.time())
+            except asyncio.TimeoutError:
+                # Finished prompts are still collected below; stuck ones time out there
+                print("Timed out waiting for prompts, collecting those that finished")
+            except websockets.WebSocketException as e:
+                print(f"WebSocket error, falling back to polling: {e}")
+    finally:
+        if ws is not None:
+            await ws.close()
+
+    # Whatever time is left, but always long enough to read finished results
+    poll_timeout = max(deadline - time.time(), HISTORY_GRACE)
+
+    async def collect(pid):
+        if isinstance(pid, BaseException):
+            return {"result": None, "output_path": None, "error": str(pid)}
+        try:
+            history = await poll_history(pid, poll_timeout)
+        except Exception as e:
+            return {"result": None, "output_path": None, "error": str(e)}
+        error = get_execution_error(history)
+        return {
+            "result": history,
+            "output_path": get_output_path(history),
+            "error": f"Workflow execution failed: {error}" if error else None
+        }
+
+    return await asyncio.gather(*(collect(pid) for pid in queued))
+
+
+async def run_comfyui_workflow(workflow: dict) -> dict:
+    """
+    Execute a ComfyUI workflow and return its history entry and output path.
+
+    This uses ComfyUI's API to queue the workflow and its WebSocket event stream
+    to wait for completion, falling back to history polling if the socket is
+    unavailable.
+    """
+    run = (await run_comfyui_workflows([workflow]))[0]
+    if run["error"]:
+        raise Exception(run["error"])
+    return run
+
+
+def get_execution_error(history: dict) -> str:
+    """Return ComfyUI's error message for a failed prompt, or None."""
+    status = history.get("status", {})
+    if status.get("status_str") != "error":
+        return None
+    for event, data in status.get("messages", []):
+        if event == "execution_error":
+            return data.get("exception_message") or "unknown error"
+    return "unknown error"
+
+
+def get_output_path(history: dict, node_id: str = "7") -> str:
+    """Resolve the video written by the VHS_VideoCombine node from its history entry."""
+    node_outputs = history.get("outputs", {}).get(node_id, {})
+    for key in ("gifs", "videos"):
+        for item in node_outputs.get(key, []):
+            if item.get("type", "output") == "output" and item.get("filename"):
+                return os.path.join(OUTPUT_DIR, item.get("subfolder", ""), item["filename"])
+    return None
+
+
+def find_latest_output(since: float = 0, prefix: str = "liveportrait_output",
+                       require_prefix: bool = False) -> str:
+    """
+    Return the newest video in OUTPUT_DIR created at or after `since`.
+
+    Files whose name starts with `prefix` win over other videos, mirroring the
+    filename_prefix used by the workflow. With `require_prefix`, other videos
+    are ignored entirely.
+    """
+    best = None
+    best_key = None
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            if os.path.splitext(entry.name)[1].lower() not in VIDEO_EXTENSIONS:
+                continue
+            if not entry.is_file():
+                continue
+            has_prefix = entry.name.startswith(prefix)
+            if require_prefix and not has_prefix:
+                continue
+            ctime = entry.stat().st_ctime
+            if ctime < since:
+                continue
+            key = (has_prefix, ctime)
+            if best_key is None or key > best_key:
+                best, best_key = entry.path, key
+    return best
+
+
+def plan_inputs(job_input: dict, suffix: str = "") -> list:
+    """
+    Resolve where each input comes from and the filename it will be staged as.
 
+    Returns a list of (name, fetch_fn, value, filename) tuples, where name is
+    "source", "driving" or "audio". `suffix` keeps batch items from overwriting
+    each other's files.
+    """
+    # Process source image
+    source_image = get_input_source(job_input, "source_image")
+    if not source_image:
+        raise ValueError("source_image, source_image_url or source_image_s3_key is required")
+
+    # Process driving video
+    driving_video = get_input_source(job_input, "driving_video")
+    if not driving_video:
+        raise ValueError("driving_video, driving_video_url or driving_video_s3_key is required")
+
+    inputs = [
+        ("source", *source_image, f"source{suffix}.png"),
+        ("driving", *driving_video, f"driving{suffix}.mp4")
+    ]
+
+    # Process optional audio
+    audio = get_input_source(job_input, "audio")
+    if audio:
+        inputs.append(("audio", *audio, f"audio{suffix}.wav"))
+
+    return inputs
+
+
+async def stage_inputs(inputs: list) -> list:
+    """Fetch planned inputs concurrently; returns each staged path or the exception raised."""
+    return await asyncio.gather(*(
+        asyncio.to_thread(fetch, value, filename) for _, fetch, value, filename in inputs
+    ), return_exceptions=True)
+
+
+def build_workflow(job_input: dict, paths: dict, video_format: str,
+                   filename_prefix: str = "liveportrait_output") -> dict:
+    """Generate the LivePortrait workflow for one job's inputs and settings."""
+    return get_liveportrait_workflow(
+        source_image_path=paths["source"],
+        driving_video_path=paths["driving"],
+        audio_path=paths["audio"],
+        flag_relative=job_input.get("flag_relative", True),
+        flag_do_crop=job_input.get("flag_do_crop", True),
+        flag_pasteback=job_input.get("flag_pasteback", True),
+        driving_smooth=job_input.get("driving_smooth", True),
+        driving_multiplier=job_input.get("driving_multiplier", 1.0),
+        max_frames=job_input.get("max_frames", 0),
+        fps_divisor=job_input.get("fps_divisor", 1),
+        force_rate=job_input.get("force_rate", 0),
+        video_format=video_format,
+        filename_prefix=filename_prefix
+    )
+
+
+async def encode_output(output_file: str) -> dict:
+    """Upload the video to object storage, or inline it as base64."""
+    # Prefer object storage; fall back to inline base64
+    if OUTPUT_BUCKET:
+        return {"video_url": await asyncio.to_thread(upload_to_s3, output_file)}
+
+    video_base64 = await asyncio.to_thread(file_to_base64, output_file)
+
+    return {
+        "video_base64": f"data:video/mp4;base64,{video_base64}"
+    }
+
+
+async def handle_batch(job_input: dict) -> dict:
+    """
+    Process `job_input["batch"]`, a list of source/driving pairs, in one invocation.
 
-def handler(event: dict) -> dict:
+    Top-level settings apply to every item unless the item overrides them. All
+    prompts are queued to ComfyUI together; each item gets its own result or error.
+    """
+    shared = {k: v for k, v in job_input.items() if k != "batch"}
+    items = [{**shared, **item} for item in job_input["batch"]]
+    if not items:
+        return {"error": "batch must contain at least one item"}
+
+    results = [None] * len(items)
+    plans = {}
+    for idx, item in enumerate(items):
+        try:
+            plans[idx] = plan_inputs(item, suffix=f"_{idx}")
+        except ValueError as e:
+            results[idx] = {"error": str(e)}
+
+    # Fetch every item's inputs concurrently
+    planned = [(idx, entry) for idx, inputs in plans.items() for entry in inputs]
+    outcomes = await stage_inputs([entry for _, entry in planned])
+    staged = [path for path in outcomes if not isinstance(path, BaseException)]
+    paths = {idx: {"audio": None} for idx in plans}
+    for (idx, (name, _, _, filename)), outcome in zip(planned, outcomes):
+        if isinstance(outcome, BaseException):
+            if results[idx] is None:
+                results[idx] = {"error": f"Failed to fetch input for {filename}: {outcome}"}
+        else:
+            paths[idx][name] = outcome
+
+    try:
+        await run_batch(items, paths, results)
+    finally:
+        remove_staged_inputs(staged)
+
+    return {"results": results}
+
+
+async def run_batch(items: list, paths: dict, results: list):
+    """Queue the batch items that have no error yet and fill in their results."""
+    video_format = get_video_format()
+    ready = []
+    workflows = []
+    for idx in paths:
+        if results[idx] is not None:
+            continue
+        try:
+            workflows.append(build_workflow(items[idx], paths[idx], video_format,
+                                            filename_prefix=f"liveportrait_output_{idx}"))
+        except (TypeError, ValueError) as e:
+            results[idx] = {"error": f"Invalid settings for batch item {idx}: {e}"}
+            continue
+        ready.append(idx)
+
+    print(f"Generated {len(workflows)} workflows, executing...")
+
+    started_at = time.time()
+    runs = await run_comfyui_workflows(workflows) if workflows else []
+
+    for idx, run in zip(ready, runs):
+        if run["error"]:
+            results[idx] = {"error": run["error"]}
+            continue
+
+        output_file = run["output_path"]
+        if not output_file or not os.path.isfile(output_file):
+            output_file = find_latest_output(since=started_at, prefix=f"liveportrait_output_{idx}_",
+                                             require_prefix=True)
+        if not output_file:
+            results[idx] = {"error": f"No output video generated for batch item {idx}"}
+            continue
+
+        try:
+            results[idx] = await encode_output(output_file)
+        except Exception as e:
+            results[idx] = {"error": f"Failed to return output for batch item {idx}: {e}"}
+
+
+async def handler(event: dict) -> dict:
     """
     RunPod serverless handler function.
 
     Receives input, processes through LivePortrait, returns output.
     """
+    staged = []
     try:
         job_input = event.get("input", {})
 
         print(f"Received job input: {list(job_input.keys())}")
 
-        # Process source image
-        source_image = job_input.get("source_image") or job_input.get("source_image_url")
-        if not source_image:
-            return {"error": "source_image or source_image_url is required"}
+        if "batch" in job_input:
+            return await handle_batch(job_input)
 
-        source_path = os.path.join(INPUT_DIR, "source.png")
-        if source_image.startswith("http"):
-            download_file(source_image, source_path)
-        else:
-            save_base64_file(source_image, source_path)
+        try:
+            inputs = plan_inputs(job_input)
+        except ValueError as e:
+            return {"error": str(e)}
 
-        # Process driving video
-        driving_video = job_input.get("driving_video") or job_input.get("driving_video_url")
-        if not driving_video:
-            return {"error": "driving_video or driving_video_url is required"}
+        # Fetch all inputs concurrently so remote downloads overlap
+        outcomes = await stage_inputs(inputs)
+        staged = [path for path in outcomes if not isinstance(path, BaseException)]
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        paths = {"audio": None, **{name: path for (name, *_), path in zip(inputs, outcomes)}}
 
-        driving_path = os.path.join(INPUT_DIR, "driving.mp4")
-        if driving_video.startswith("http"):
-            download_file(driving_video, driving_path)
-        else:
-            save_base64_file(driving_video, driving_path)
-
-        # Process optional audio
-        audio_path = None
-        audio = job_input.get("audio") or job_input.get("audio_url")
-        if audio:
-            audio_path = os.path.join(INPUT_DIR, "audio.wav")
-            if audio.startswith("http"):
-                download_file(audio, audio_path)
-            else:
-                save_base64_file(audio, audio_path)
-
-        print(f"Source image saved to: {source_path}")
-        print(f"Driving video saved to: {driving_path}")
-        if audio_path:
-            print(f"Audio saved to: {audio_path}")
+        print(f"Source image saved to: {paths['source']}")
+        print(f"Driving video saved to: {paths['driving']}")
+        if paths["audio"]:
+            print(f"Audio saved to: {paths['audio']}")
 
         # Generate workflow
-        workflow = get_liveportrait_workflow(
-            source_image_path=source_path,
-            driving_video_path=driving_path,
-            audio_path=audio_path,
-            flag_relative=job_input.get("flag_relative", True),
-            flag_do_crop=job_input.get("flag_do_crop", True),
-            flag_pasteback=job_input.get("flag_pasteback", True),
-            driving_smooth=job_input.get("driving_smooth", True),
-            driving_multiplier=job_input.get("driving_multiplier", 1.0)
-        )
+        workflow = build_workflow(job_input, paths, get_video_format())
 
         print("Generated workflow, executing...")
 
         # Execute workflow
-        result = run_comfyui_workflow(workflow)
+        started_at = time.time()
+        run = await run_comfyui_workflow(workflow)
 
-        print(f"Workflow completed: {result}")
+        print(f"Workflow completed: {run['result']}")
 
         # Debug: List all files in output directory
-        print(f"Checking output directory: {OUTPUT_DIR}")
-        all_files = list(Path(OUTPUT_DIR).glob("*"))
-        print(f"All files in output: {[str(f) for f in all_files]}")
-
-        # Find output video - check multiple patterns
-        output_files = list(Path(OUTPUT_DIR).glob("liveportrait_output*.mp4"))
-        if not output_files:
-            # Try any mp4 file
-            output_files = list(Path(OUTPUT_DIR).glob("*.mp4"))
-        if not output_files:
-            # Try any video file
-            output_files = list(Path(OUTPUT_DIR).glob("*.*"))
-            output_files = [f for f in output_files if f.suffix.lower() in ['.mp4', '.webm', '.avi', '.mov']]
-
-        if not output_files:
-            return {"error": f"No output video generated. Files in output dir: {[str(f) for f in all_files]}"}
+        if DEBUG_LIST_OUTPUTS:
+            print(f"Checking output directory: {OUTPUT_DIR}")
+            all_files = list(Path(OUTPUT_DIR).iterdir())
+            print(f"All files in output: {[str(f) for f in all_files]}")
 
-        # Get the most recent output
-        output_file = max(output_files, key=os.path.getctime)
+        # Use the path reported by ComfyUI; scan the output dir only as a fallback
+        output_file = run["output_path"]
+        if not output_file or not os.path.isfile(output_file):
+            output_file = find_latest_output(since=started_at)
 
-        # Return as base64
-        video_base64 = file_to_base64(str(output_file))
+        if not output_file:
+            return {"error": f"No output video generated in {OUTPUT_DIR}"}
 
-        return {
-            "video_base64": f"data:video/mp4;base64,{video_base64}"
-        }
+        return await encode_output(str(output_file))
 
     except Exception as e:
         print(f"Error: {str(e)}")
         import traceback
         traceback.print_exc()
         return {"error": str(e)}
+    finally:
+        remove_staged_inputs(staged)
+
+
+def prune_outputs(max_age: float):
+    """Delete files in OUTPUT_DIR not modified within the last `max_age` seconds."""
+    cutoff = time.time() - max_age
+    removed = 0
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError:
+                continue  # Vanished or in use; try again next pass
+    if removed:
+        print(f"Pruned {removed} old files from {OUTPUT_DIR}")
+
+
+def _prune_outputs_loop():
+    """Background loop keeping OUTPUT_DIR bounded over the worker's lifetime."""
+    while True:
+        try:
+            prune_outputs(OUTPUT_MAX_AGE)
+        except Exception as e:
+            print(f"Output pruning failed: {e}")
+        time.sleep(OUTPUT_PRUNE_INTERVAL)
+
+
+async def _warmup():
+    """
+    Load the LivePortrait models and face cropper before the first job, and pick
+    the output video format.
+
+    ComfyUI only executes nodes that feed an output node, so nodes 1 and 2 are
+    pulled in through a cropper run on a blank image with a PreviewImage sink.
+    Their outputs stay cached for subsequent prompts.
+    """
+    from PIL import Image
+
+    warmup_image = os.path.join(COMFYUI_INPUT_DIR, "warmup.png")
+    Image.new("RGB", (512, 512)).save(warmup_image)
+
+    workflow = {
+        "1": _WORKFLOW_TEMPLATE["1"],
+        "2": _WORKFLOW_TEMPLATE["2"],
+        "3": {
+            "class_type": "LoadImage",
+            "inputs": {"image": comfy_input_name(warmup_image)}
+        },
+        "5": _WORKFLOW_TEMPLATE["5"],
+        "9": {
+            "class_type": "PreviewImage",
+            "inputs": {"images": ["5", 0]}
+        }
+    }
+
+    start_time = time.time()
+    try:
+        await detect_video_format()
+        await run_comfyui_workflow(workflow)
+        print(f"Warmup completed in {time.time() - start_time:.1f}s")
+    except Exception as e:
+        # A blank image has no face, so the cropper may fail after the models load
+        print(f"Warmup finished with error after {time.time() - start_time:.1f}s: {e}")
+    finally:
+        # The client's connections belong to this event loop; RunPod runs its own
+        await get_comfyui_client().aclose()
 
 
 # Start the serverless handler
 if __name__ == "__main__":
+    if OUTPUT_MAX_AGE > 0:
+        threading.Thread(target=_prune_outputs_loop, daemon=True).start()
+    try:
+        asyncio.run(_warmup())
+    except Exception as e:
+        print(f"Warmup failed: {e}")
     runpod.serverless.start({"handler": handler})
@@ -3,7 +3,13 @@
 
 echo "Starting ComfyUI server in background..."
 cd /content/ComfyUI
-python main.py --listen --port 7860 &
+# COMFYUI_CACHE_LRU=N keeps the last N node results cached across prompts
+# instead of only those from the previous prompt
+CACHE_ARGS=""
+if [ -n "$COMFYUI_CACHE_LRU" ]; then
+    CACHE_ARGS="--cache-lru $COMFYUI_CACHE_LRU"
+fi
+python main.py --listen --port 7860 $CACHE_ARGS &
 
 # Wait for ComfyUI to be ready
 echo "Waiting for ComfyUI to start..."